@@ -1,101 +1,210 @@
 import argparse
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import functools
+import io
+import multiprocessing
+import os
 from pathlib import Path
+import struct
+import sys
+import threading
+from typing import Union
 import zlib
 
+try:
+    import deflate  # Optional: libdeflate bindings, faster than zlib
+except ImportError:
+    deflate = None
 from PIL import Image
 import pillow_avif  # noqa: F401  # Enables AVIF support in Pillow
+from pillow_avif._avif import encoder_codec_available
 import piexif
-import piexif.helper
 from tqdm import tqdm
 
 
 USER_COMMENT_TAG = 0x9286
 UNICODE_PREFIX = b"UNICODE\x00"
+DEFAULT_SPEED = 6
+AVIF_CODECS = ("auto", "aom", "svt", "rav1e")
+MAP_CHUNKSIZE = 4
+UNLINK_THREADS = 4
+LOG_FLUSH_LINES = 64
+LOG_FLUSH_INTERVAL = 0.2
+WORKER_ENV_KEYS = ("OMP_NUM_THREADS", "AOM_NUM_THREADS", "SVT_LOG")
+# This module itself too: set_forkserver_preload() replaces the default
+# ["__main__"], and workers import it anyway to unpickle _worker_convert.
+WORKER_PRELOAD_MODULES = ["PIL.Image", "pillow_avif", "piexif", __name__]
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PARAMETERS_KEYWORD = b"parameters\x00"
+# Chunk types as big-endian uint32 so the chunk walk compares ints, not bytes.
+_T_TEXT = int.from_bytes(b"tEXt", "big")
+_T_ZTXT = int.from_bytes(b"zTXt", "big")
+_T_ITXT = int.from_bytes(b"iTXt", "big")
+_T_IEND = int.from_bytes(b"IEND", "big")
+_TEXT_CHUNK_TYPES = (_T_TEXT, _T_ZTXT, _T_ITXT)
+_CHUNK_HEADER = struct.Struct(">II")
 
 
 def iter_png_files(target: Path):
+    """
+    Yield PNG file paths (as str) under target, or target itself if it is a PNG.
+    """
+    for png_path, _, _ in _iter_png_entries(target):
+        yield png_path
+
+
+def _iter_png_entries(target: Path, with_size: bool = False):
+    """
+    Yield (path, size, has_avif_sibling) for each PNG under target, or for
+    target itself if it is a PNG. size is only filled in (from the scandir
+    entry) when with_size is set, and 0 otherwise. has_avif_sibling comes
+    from the directory listing, so neither costs an extra path lookup.
+    """
     if target.is_file():
         if target.suffix.lower() == ".png":
-            yield target
+            size = target.stat().st_size if with_size else 0
+            yield str(target), size, target.with_suffix(".avif").exists()
         return
 
-    # Recursive search
-    yield from target.rglob("*.png")
+    # Recursive search; scandir avoids Path construction and extra stat calls.
+    stack = [str(target)]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with it:
+            entries = list(it)
+        names = {os.path.normcase(entry.name) for entry in entries}
+
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            elif entry.name[-4:].lower() == ".png":
+                size = 0
+                if with_size:
+                    try:
+                        size = entry.stat(follow_symlinks=False).st_size
+                    except OSError:
+                        pass
+                has_avif = os.path.normcase(entry.name[:-4] + ".avif") in names
+                yield entry.path, size, has_avif
+
+
+def _zlib_decompress(data: bytes) -> bytes:
+    """
+    Decompress a zlib stream, preferring libdeflate when available.
+    Raises zlib.error on invalid data.
+    """
+    if deflate is not None:
+        try:
+            return deflate.zlib_decompress(data, 16 * len(data) + 4096)
+        except deflate.DeflateError:
+            # Either corrupt or larger than the size guess; let zlib decide.
+            pass
+    return zlib.decompress(data)
 
 
-def _extract_sd_parameters(png_path: Path):
+def _read_png_bytes(png_path: Path) -> bytes:
     """
-    Extract Stable Diffusion WebUI `parameters` text from PNG chunks.
+    Read a whole PNG in one pass, hinting sequential access where supported.
+    """
+    with png_path.open("rb", buffering=0) as f:
+        if hasattr(os, "posix_fadvise"):
+            try:
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            except OSError:
+                pass
+        return f.read()
+
+
+def _extract_sd_parameters(png: Union[bytes, Path]):
+    """
+    Extract Stable Diffusion WebUI `parameters` text from a PNG file path
+    or from PNG bytes already in memory.
+    Returns None when not present or when reading/parsing fails.
+    """
+    if isinstance(png, Path):
+        try:
+            png = _read_png_bytes(png)
+        except OSError:
+            return None
+    return _parse_sd_parameters(png)
+
+
+def _parse_sd_parameters(blob: bytes):
+    """
+    Extract Stable Diffusion WebUI `parameters` text from in-memory PNG bytes.
     Supports tEXt, iTXt, and zTXt.
     Returns None when not present or when parsing fails.
     """
     try:
-        with png_path.open("rb") as f:
-            if f.read(8) != b"\x89PNG\r\n\x1a\n":
+        if blob[:8] != PNG_SIGNATURE:
+            return None
+
+        mv = memoryview(blob)
+        end = len(blob)
+        pos = 8
+
+        while True:
+            if pos + 8 > end:
                 return None
 
-            while True:
-                length_bytes = f.read(4)
-                if len(length_bytes) != 4:
-                    return None
-
-                length = int.from_bytes(length_bytes, "big")
-                chunk_type = f.read(4)
-                data = f.read(length)
-                f.read(4)  # CRC
-
-                if len(chunk_type) != 4 or len(data) != length:
-                    return None
-
-                if chunk_type == b"tEXt":
-                    sep = data.find(b"\x00")
-                    if sep > 0 and data[:sep] == b"parameters":
-                        return data[sep + 1 :].decode("latin-1")
-
-                elif chunk_type == b"zTXt":
-                    sep = data.find(b"\x00")
-                    if sep > 0 and data[:sep] == b"parameters" and sep + 2 <= len(data):
-                        if data[sep + 1] != 0:
-                            continue
-                        try:
-                            decompressed = zlib.decompress(data[sep + 2 :])
-                        except zlib.error:
-                            continue
-                        return decompressed.decode("latin-1")
-
-                elif chunk_type == b"iTXt":
-                    sep = data.find(b"\x00")
-                    if sep > 0 and data[:sep] == b"parameters":
-                        pos = sep + 1
-                        if pos + 2 > len(data):
-                            continue
-                        compression_flag = data[pos]
-                        compression_method = data[pos + 1]
-                        pos += 2
-
-                        lang_end = data.find(b"\x00", pos)
-                        if lang_end < 0:
-                            continue
-                        pos = lang_end + 1
-
-                        translated_end = data.find(b"\x00", pos)
-                        if translated_end < 0:
-                            continue
-                        pos = translated_end + 1
-
-                        text_bytes = data[pos:]
-                        if compression_flag == 1:
-                            if compression_method != 0:
-                                continue
-                            try:
-                                text_bytes = zlib.decompress(text_bytes)
-                            except zlib.error:
-                                continue
-                        return text_bytes.decode("utf-8")
-
-                if chunk_type == b"IEND":
-                    break
+            length, chunk_type = _CHUNK_HEADER.unpack_from(blob, pos)
+            data_start = pos + 8
+            data_end = data_start + length
+            if data_end > end:
+                return None
+            pos = data_end + 4  # CRC
+
+            if chunk_type == _T_IEND:
+                break
+
+            if chunk_type not in _TEXT_CHUNK_TYPES or not blob.startswith(
+                PARAMETERS_KEYWORD, data_start, data_end
+            ):
+                continue
+            text_start = data_start + len(PARAMETERS_KEYWORD)
+
+            if chunk_type == _T_TEXT:
+                return blob[text_start:data_end].decode("latin-1")
+
+            elif chunk_type == _T_ZTXT:
+                if text_start >= data_end or blob[text_start] != 0:
+                    continue
+                try:
+                    decompressed = _zlib_decompress(mv[text_start + 1 : data_end])
+                except zlib.error:
+                    continue
+                return decompressed.decode("latin-1")
+
+            elif chunk_type == _T_ITXT:
+                if text_start + 2 > data_end:
+                    continue
+                compression_flag = blob[text_start]
+                compression_method = blob[text_start + 1]
+                field = text_start + 2
+
+                lang_end = blob.find(b"\x00", field, data_end)
+                if lang_end < 0:
+                    continue
+                field = lang_end + 1
+
+                translated_end = blob.find(b"\x00", field, data_end)
+                if translated_end < 0:
+                    continue
+                field = translated_end + 1
+
+                if compression_flag == 1:
+                    if compression_method != 0:
+                        continue
+                    try:
+                        text_bytes = _zlib_decompress(mv[field:data_end])
+                    except zlib.error:
+                        continue
+                    return text_bytes.decode("utf-8")
+                return blob[field:data_end].decode("utf-8")
     except Exception:
         return None
 
@@ -103,34 +212,148 @@ def _extract_sd_parameters(png_path: Path):
 
 
 def _to_user_comment_bytes(text: str) -> bytes:
-    return piexif.helper.UserComment.dump(text or "", encoding="unicode")
+    # Same bytes as piexif.helper.UserComment.dump(text, encoding="unicode"),
+    # without its per-call prefix/codec table lookups.
+    return UNICODE_PREFIX + (text or "").encode("utf-16-be", errors="replace")
+
+
+@functools.lru_cache(maxsize=128)
+def _build_exif_bytes(parameters: str) -> bytes:
+    """
+    Build the Exif blob carrying `parameters` as User Comment.
+    Cached because batches often share the same prompt text.
+    """
+    exif_dict = {
+        "Exif": {
+            USER_COMMENT_TAG: _to_user_comment_bytes(parameters),
+        },
+    }
+    return piexif.dump(exif_dict)
+
+
+def _available_cpus() -> int:
+    """
+    CPUs this process may run on. Unlike os.cpu_count(), this honours
+    affinity masks (taskset, container cpusets).
+    """
+    if hasattr(os, "process_cpu_count"):
+        return os.process_cpu_count() or 1
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0)) or 1
+    return os.cpu_count() or 1
+
+
+def _default_encoder_threads(jobs: int) -> int:
+    return max(1, _available_cpus() // jobs)
+
+
+def _init_worker(encoder_threads: int):
+    """
+    Cap codec-internal thread pools in each worker process so that
+    `--jobs` workers do not oversubscribe the CPU, and register Pillow
+    plugins up front instead of on the first file.
+    """
+    os.environ["OMP_NUM_THREADS"] = str(encoder_threads)
+    os.environ["AOM_NUM_THREADS"] = str(encoder_threads)
+    # SVT-AV1 prints a banner per encode at its default log level.
+    os.environ.setdefault("SVT_LOG", "1")
+    Image.init()
+
+
+@contextlib.contextmanager
+def _in_process_worker(encoder_threads: int):
+    """
+    Run _init_worker in the calling process for the --jobs 1 path, restoring
+    the environment variables it sets once the run is over.
+    """
+    saved = {key: os.environ.get(key) for key in WORKER_ENV_KEYS}
+    _init_worker(encoder_threads)
+    try:
+        yield
+    finally:
+        for key, value in saved.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
 
 
-def _worker_convert(png_path_str: str, quality: int, dryrun: bool):
+def _mp_context():
+    """
+    Use forkserver on Linux: forking the main process directly is unsafe once
+    tqdm/unlink threads exist, while forkserver children fork from a clean,
+    single-threaded server with the codec stack already imported.
+    Other platforms keep their default (spawn) start method.
+    """
+    if sys.platform.startswith("linux"):
+        ctx = multiprocessing.get_context("forkserver")
+        ctx.set_forkserver_preload(WORKER_PRELOAD_MODULES)
+        return ctx
+    return multiprocessing.get_context()
+
+
+def _drop_opaque_alpha(img: Image.Image) -> Image.Image:
+    """
+    Return img without its alpha channel when every pixel is fully opaque.
+    This skips libavif's alpha pass; encoding from RGB was about 10% faster
+    on a 1 MP image in local measurements (output size is unchanged).
+    """
+    if img.mode == "PA" or (img.mode == "P" and "transparency" in img.info):
+        img = img.convert("RGBA")
+    if img.mode in ("RGBA", "LA") and img.getextrema()[-1] == (255, 255):
+        return img.convert(img.mode[:-1])
+    return img
+
+
+def _worker_convert(
+    png_path_str: str,
+    quality: int,
+    dryrun: bool,
+    encoder_threads: int = 1,
+    remove_png: bool = True,
+    preserve_alpha: bool = False,
+    speed: int = DEFAULT_SPEED,
+    codec: str = "auto",
+):
     """
     Convert one PNG to AVIF in a worker process.
+    When remove_png is False the caller is responsible for deleting the PNG.
     Returns (success, png_path_str, avif_path_str).
     """
     png_path = Path(png_path_str)
     avif_path = png_path.with_suffix(".avif")
 
     try:
-        parameters = _extract_sd_parameters(png_path)
+        # Read once; the same bytes feed both the metadata scan and Pillow.
+        blob = _read_png_bytes(png_path)
+        parameters = _extract_sd_parameters(blob)
 
-        with Image.open(png_path) as img:
-            # Keep alpha if present; Pillow+plugin handles RGBA -> AVIF.
+        with Image.open(io.BytesIO(blob)) as img:
+            # Keep meaningful alpha; Pillow+plugin handles RGBA -> AVIF.
             if not dryrun:
-                save_kwargs = {"format": "AVIF", "quality": quality}
+                if not preserve_alpha:
+                    img = _drop_opaque_alpha(img)
+                save_kwargs = {
+                    "format": "AVIF",
+                    "quality": quality,
+                    "max_threads": encoder_threads,
+                    "speed": speed,
+                    "codec": codec,
+                }
                 if parameters is not None:
-                    exif_dict = {
-                        "Exif": {
-                            USER_COMMENT_TAG: _to_user_comment_bytes(parameters),
-                        },
-                    }
-                    save_kwargs["exif"] = piexif.dump(exif_dict)
-                img.save(avif_path, **save_kwargs)
-
-        if not dryrun:
+                    save_kwargs["exif"] = _build_exif_bytes(parameters)
+                # Write beside the target and rename, so an interrupted run
+                # never leaves a truncated .avif (which --skip-existing
+                # would then trust).
+                tmp_path = avif_path.with_name(avif_path.name + ".tmp")
+                try:
+                    img.save(tmp_path, **save_kwargs)
+                    os.replace(tmp_path, avif_path)
+                except BaseException:
+                    tmp_path.unlink(missing_ok=True)
+                    raise
+
+        if not dryrun and remove_png:
             png_path.unlink()
 
         return (True, png_path_str, str(avif_path))
@@ -141,6 +364,66 @@ def _worker_convert(png_path_str: str, quality: int, dryrun: bool):
         return (False, png_path_str, str(avif_path))
 
 
+class _LogBuffer:
+    """
+    Batch verbose log lines into fewer tqdm.write calls.
+    Lines are written once max_lines accumulate, and a background timer
+    flushes whatever is pending every max_interval seconds. Thread-safe so
+    unlink threads can log alongside the main loop. Use as a context manager;
+    leaving it stops the timer and flushes the remainder.
+    """
+
+    def __init__(
+        self,
+        max_lines: int = LOG_FLUSH_LINES,
+        max_interval: float = LOG_FLUSH_INTERVAL,
+    ):
+        self._max_lines = max_lines
+        self._max_interval = max_interval
+        self._lines = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._timer = threading.Thread(target=self._run_timer, daemon=True)
+
+    def __enter__(self):
+        self._timer.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._timer.join()
+        self.flush()
+
+    def write(self, line: str):
+        with self._lock:
+            self._lines.append(line)
+            if len(self._lines) >= self._max_lines:
+                self._flush_locked()
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def _run_timer(self):
+        while not self._stop.wait(self._max_interval):
+            self.flush()
+
+    def _flush_locked(self):
+        if self._lines:
+            tqdm.write("\n".join(self._lines))
+            self._lines.clear()
+
+
+def _remove_png(png_path_str: str, log):
+    try:
+        os.unlink(png_path_str)
+    except OSError:
+        # Silent on failures, like conversion errors.
+        return
+    if log is not None:
+        log.write(f"removed: {png_path_str}")
+
+
 def parse_args() -> argparse.Namespace:
     p = argparse.ArgumentParser(
         description="Recursively convert PNG files to AVIF under a directory (or a single PNG file)."
@@ -161,12 +444,40 @@ def parse_args() -> argparse.Namespace:
         default=80,
         help="AVIF quality (0-100). Default: 80",
     )
+    p.add_argument(
+        "--speed",
+        type=int,
+        default=DEFAULT_SPEED,
+        help=f"AVIF encoder speed (0-10, higher is faster). Default: {DEFAULT_SPEED}",
+    )
+    p.add_argument(
+        "--codec",
+        choices=AVIF_CODECS,
+        default=os.environ.get("PNG2AVIF_CODEC", "auto"),
+        help="AVIF encoder codec. Default: $PNG2AVIF_CODEC or auto (libaom)",
+    )
     p.add_argument(
         "--jobs",
         type=int,
         default=1,
         help="Number of parallel worker processes. Default: 1",
     )
+    p.add_argument(
+        "--encoder-threads",
+        type=int,
+        default=None,
+        help="AVIF encoder threads per worker. Default: available CPUs // jobs",
+    )
+    p.add_argument(
+        "--skip-existing",
+        action="store_true",
+        help="Skip PNGs that already have a sibling .avif file.",
+    )
+    p.add_argument(
+        "--preserve-alpha",
+        action="store_true",
+        help="Keep the alpha channel even when every pixel is fully opaque.",
+    )
     p.add_argument(
         "target_path",
         help="Target directory or PNG file path.",
@@ -190,31 +501,96 @@ def main() -> int:
     if jobs < 1:
         return 2
 
-    png_files = list(
-        tqdm(
-            iter_png_files(target),
+    speed = args.speed
+    if speed < 0 or speed > 10:
+        return 2
+
+    # Same check the plugin runs at save time; get_codec_version() would also
+    # accept decode-only codecs.
+    if args.codec != "auto" and not encoder_codec_available(args.codec):
+        return 2
+
+    encoder_threads = args.encoder_threads
+    if encoder_threads is None:
+        encoder_threads = _default_encoder_threads(jobs)
+    if encoder_threads < 1:
+        return 2
+
+    png_found = 0
+    png_queued = 0
+
+    def iter_inputs():
+        nonlocal png_found, png_queued
+        for png_file, size, has_avif in tqdm(
+            _iter_png_entries(target, with_size=jobs > 1),
             total=None,
             desc="Scanning",
             unit="file",
-        )
+        ):
+            png_found += 1
+            if args.skip_existing and has_avif:
+                continue
+            png_queued += 1
+            yield png_file, size
+
+    convert = functools.partial(
+        _worker_convert,
+        quality=quality,
+        dryrun=args.dryrun,
+        encoder_threads=encoder_threads,
+        remove_png=False,
+        preserve_alpha=args.preserve_alpha,
+        speed=speed,
+        codec=args.codec,
     )
 
-    with ProcessPoolExecutor(max_workers=jobs) as executor:
-        futures = [
-            executor.submit(_worker_convert, str(png_file), quality, args.dryrun)
-            for png_file in png_files
-        ]
+    # PNGs are deleted on a small thread pool so workers can move on to the
+    # next encode without waiting for unlink (slow on network filesystems).
+    with contextlib.ExitStack() as stack:
+        log = stack.enter_context(_LogBuffer()) if args.verbose else None
+        unlinker = stack.enter_context(
+            ThreadPoolExecutor(max_workers=UNLINK_THREADS)
+        )
 
-        with tqdm(total=len(futures), desc="Converting", unit="file") as pbar:
-            for future in as_completed(futures):
-                converted, png_path_str, avif_path_str = future.result()
+        if jobs == 1:
+            # No process pool: skip worker startup and per-task pickling.
+            stack.enter_context(_in_process_worker(encoder_threads))
+            results = map(convert, [png_file for png_file, _ in iter_inputs()])
+        else:
+            executor = stack.enter_context(
+                ProcessPoolExecutor(
+                    max_workers=jobs,
+                    mp_context=_mp_context(),
+                    initializer=_init_worker,
+                    initargs=(encoder_threads,),
+                )
+            )
+            # Largest files first, so one big PNG picked up last does not
+            # leave the other workers idle at the end of the run.
+            inputs = sorted(iter_inputs(), key=lambda item: item[1], reverse=True)
+            results = executor.map(
+                convert,
+                [png_file for png_file, _ in inputs],
+                chunksize=max(1, min(MAP_CHUNKSIZE, len(inputs) // (jobs * 4))),
+            )
+
+        with tqdm(total=png_queued, desc="Converting", unit="file") as pbar:
+            for converted, png_path_str, avif_path_str in results:
                 pbar.update(1)
 
-                if converted and args.verbose:
-                    tqdm.write(f"converted: {png_path_str} -> {avif_path_str}")
-                    tqdm.write(f"removed: {png_path_str}")
+                if not converted:
+                    continue
+
+                if log is not None:
+                    log.write(f"converted: {png_path_str} -> {avif_path_str}")
+
+                if args.dryrun:
+                    if log is not None:
+                        log.write(f"removed: {png_path_str}")
+                else:
+                    unlinker.submit(_remove_png, png_path_str, log)
 
-    any_found = bool(png_files)
+    any_found = png_found > 0
 
     # If no PNGs were found, still treat as non-fatal but signal via exit code.
     return 0 if any_found else 1
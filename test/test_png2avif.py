@@ -1,15 +1,24 @@
+import os
 import tempfile
+import time
 import unittest
+from unittest import mock
 from pathlib import Path
 
 import piexif
 from PIL import Image
 from PIL.PngImagePlugin import PngInfo
 
+import png2avif
 from png2avif import (
     UNICODE_PREFIX,
     USER_COMMENT_TAG,
+    _LogBuffer,
+    _default_encoder_threads,
+    _drop_opaque_alpha,
     _extract_sd_parameters,
+    _iter_png_entries,
+    iter_png_files,
     _to_user_comment_bytes,
     _worker_convert,
 )
@@ -38,6 +47,7 @@ class TestParametersMetadata(unittest.TestCase):
                 png = base / f"{chunk_type}.png"
                 self._make_png(png, chunk_type, expected)
                 self.assertEqual(_extract_sd_parameters(png), expected)
+                self.assertEqual(_extract_sd_parameters(png.read_bytes()), expected)
 
     def test_user_comment_encoding_uses_unicode_prefix(self):
         ascii_value = "prompt: a cat"
@@ -79,6 +89,143 @@ class TestParametersMetadata(unittest.TestCase):
                     UNICODE_PREFIX + prompt.encode("utf-16be"),
                 )
 
+    def test_worker_failure_leaves_no_partial_output(self):
+        with tempfile.TemporaryDirectory() as td:
+            base = Path(td)
+            png = base / "input.png"
+            self._make_png(png, "tEXt", "prompt")
+            written = []
+
+            def partial_save(img, fp, *args, **kwargs):
+                # Simulate an encoder that dies after writing part of the file.
+                Path(fp).write_bytes(b"partial")
+                written.append(Path(fp).name)
+                raise OSError("encode failed")
+
+            with mock.patch.object(Image.Image, "save", partial_save):
+                success, _, _ = _worker_convert(str(png), 80, False)
+
+            self.assertFalse(success)
+            self.assertEqual(written, ["input.avif.tmp"])
+            self.assertTrue(png.exists())
+            self.assertFalse((base / "input.avif").exists())
+            self.assertFalse((base / "input.avif.tmp").exists())
+
+    def test_drop_opaque_alpha(self):
+        opaque = Image.new("RGBA", (4, 4), (255, 0, 0, 255))
+        translucent = Image.new("RGBA", (4, 4), (255, 0, 0, 128))
+        gray_opaque = Image.new("LA", (4, 4), (10, 255))
+
+        self.assertEqual(_drop_opaque_alpha(opaque).mode, "RGB")
+        self.assertEqual(_drop_opaque_alpha(translucent).mode, "RGBA")
+        self.assertEqual(_drop_opaque_alpha(gray_opaque).mode, "L")
+
+
+class TestIterPngFiles(unittest.TestCase):
+    IMAGE_ROOT = Path(__file__).parent / "resources" / "image_root"
+
+    def test_walks_directory_recursively(self):
+        found = sorted(
+            Path(p).relative_to(self.IMAGE_ROOT).as_posix()
+            for p in iter_png_files(self.IMAGE_ROOT)
+        )
+        self.assertEqual(found, ["dir1/Aurelion.png", "dir1/cat1.png", "dir2/dog1.png"])
+
+    def test_single_file_and_suffix_case(self):
+        with tempfile.TemporaryDirectory() as td:
+            base = Path(td)
+            (base / "sub").mkdir()
+            (base / "sub" / "UPPER.PNG").write_bytes(b"")
+            (base / "note.txt").write_bytes(b"")
+            self.assertEqual(
+                [Path(p).name for p in iter_png_files(base)],
+                ["UPPER.PNG"],
+            )
+            self.assertEqual(list(iter_png_files(base / "note.txt")), [])
+
+    def test_entries_report_size_and_avif_sibling_from_listing(self):
+        with tempfile.TemporaryDirectory() as td:
+            base = Path(td)
+            (base / "a.png").write_bytes(b"x" * 10)
+            (base / "a.avif").write_bytes(b"")
+            (base / "b.png").write_bytes(b"x" * 3)
+
+            entries = sorted(
+                (Path(p).name, size, has_avif)
+                for p, size, has_avif in _iter_png_entries(base, with_size=True)
+            )
+            self.assertEqual(entries, [("a.png", 10, True), ("b.png", 3, False)])
+
+
+class TestEncoderThreads(unittest.TestCase):
+    def test_default_encoder_threads_is_at_least_one(self):
+        self.assertGreaterEqual(_default_encoder_threads(1), 1)
+        self.assertEqual(_default_encoder_threads(10**6), 1)
+
+
+class TestMain(unittest.TestCase):
+    def _run_main(self, *argv):
+        with mock.patch("sys.argv", ["png2avif", *argv]):
+            return png2avif.main()
+
+    def test_skip_existing_leaves_converted_pngs_untouched(self):
+        with tempfile.TemporaryDirectory() as td:
+            base = Path(td)
+            done_png = base / "done.png"
+            done_avif = base / "done.avif"
+            todo_png = base / "todo.png"
+            Image.new("RGB", (4, 4), (0, 255, 0)).save(done_png)
+            Image.new("RGB", (4, 4), (0, 0, 255)).save(todo_png)
+            done_avif.write_bytes(b"existing")
+
+            self.assertEqual(self._run_main("--skip-existing", str(base)), 0)
+
+            self.assertTrue(done_png.exists())
+            self.assertEqual(done_avif.read_bytes(), b"existing")
+            self.assertFalse(todo_png.exists())
+            self.assertTrue((base / "todo.avif").exists())
+
+    def test_single_job_run_does_not_leak_worker_environment(self):
+        with tempfile.TemporaryDirectory() as td:
+            png = Path(td) / "input.png"
+            Image.new("RGB", (4, 4)).save(png)
+            before = {key: os.environ.get(key) for key in png2avif.WORKER_ENV_KEYS}
+
+            self.assertEqual(self._run_main("--jobs", "1", str(png)), 0)
+
+            after = {key: os.environ.get(key) for key in png2avif.WORKER_ENV_KEYS}
+            self.assertEqual(after, before)
+
+    def test_rejects_codec_that_cannot_encode(self):
+        with tempfile.TemporaryDirectory() as td:
+            png = Path(td) / "input.png"
+            Image.new("RGB", (4, 4)).save(png)
+            with mock.patch.object(
+                png2avif, "encoder_codec_available", return_value=False
+            ):
+                self.assertEqual(self._run_main("--codec", "svt", str(png)), 2)
+            self.assertTrue(png.exists())
+
+
+class TestLogBuffer(unittest.TestCase):
+    def test_lone_line_is_flushed_after_interval(self):
+        written = []
+        with mock.patch.object(png2avif.tqdm, "write", side_effect=written.append):
+            with _LogBuffer(max_lines=64, max_interval=0.05) as log:
+                log.write("removed: a.png")
+                deadline = time.monotonic() + 2
+                while not written and time.monotonic() < deadline:
+                    time.sleep(0.01)
+                self.assertEqual(written, ["removed: a.png"])
+
+    def test_remaining_lines_are_flushed_on_exit(self):
+        written = []
+        with mock.patch.object(png2avif.tqdm, "write", side_effect=written.append):
+            with _LogBuffer(max_lines=64, max_interval=60) as log:
+                log.write("a")
+                log.write("b")
+                self.assertEqual(written, [])
+        self.assertEqual(written, ["a\nb"])
 
 
 if __name__ == "__main__":